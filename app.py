@@ -1,8 +1,18 @@
+import gzip
+import http.client
+import os
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
 import numpy as np
+import orjson
 import plotly.express as px
-import requests
+import pyarrow as pa
+from pyarrow import csv as pacsv
 
 # --- Page Configuration ---
 st.set_page_config(layout="wide")
@@ -10,7 +20,15 @@ st.set_page_config(layout="wide")
 # --- Constants & Configuration ---
 CRIMES_PATH = "Index_Crimes_by_County_and_Agency__Beginning_1990_20250906.csv"
 POPULATION_PATH = "Annual_Population_Estimates_for_New_York_State_and_Counties__Beginning_1970_20250907.csv"
+# Bump whenever the cleaned loader output changes (columns, dtypes, ordering) so stale caches are ignored
+PARQUET_CACHE_VERSION = 2
+CRIMES_PARQUET_PATH = f"crimes.v{PARQUET_CACHE_VERSION}.parquet"
+POPULATION_PARQUET_PATH = f"population.v{PARQUET_CACHE_VERSION}.parquet"
 GEOJSON_URL = "https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json"
+GEOJSON_CACHE_PATH = "ny_counties.json.gz"
+NY_STATE_FIPS = "36"
+GEOJSON_TIMEOUT_SECONDS = 30
+MAP_COLOR_BINS = 16
 
 COUNTY_NORMALIZATION = {
     "St Lawrence": "St. Lawrence",
@@ -23,80 +41,263 @@ METRIC_COLUMNS = [
     'motor_vehicle_theft'
 ]
 
+# Explicit Arrow schemas for the raw CSV headers so values are parsed straight into their final types
+CRIME_COLUMN_TYPES = {
+    'Year': pa.int16(),
+    'Months Reported': pa.float32(),
+    **{col.replace('_', ' ').title(): pa.int32() for col in METRIC_COLUMNS},
+}
+POPULATION_COLUMN_TYPES = {
+    'FIPS Code': pa.string(),
+    'Year': pa.int16(),
+    'Population': pa.int64(),
+}
+ARROW_TYPES_MAPPER = {pa.int16(): pd.Int16Dtype(), pa.int32(): pd.Int32Dtype()}.get
+
 # --- Helper Functions ---
-def to_snake_case(name):
-    """Converts a string to snake_case."""
-    return name.lower().replace(' ', '_').replace('-', '_')
+def parquet_is_fresh(parquet_path, csv_path):
+    """Returns True if a cleaned Parquet copy exists and is not older than its source CSV."""
+    if not os.path.exists(parquet_path):
+        return False
+    return not os.path.exists(csv_path) or os.path.getmtime(parquet_path) >= os.path.getmtime(csv_path)
+
+def read_parquet_cache(parquet_path, csv_path):
+    """Returns the cached Parquet frame if it is fresh and readable, otherwise None."""
+    if not parquet_is_fresh(parquet_path, csv_path):
+        return None
+    try:
+        return pd.read_parquet(parquet_path)
+    except (OSError, ValueError):
+        return None
+
+def write_parquet_cache(df, parquet_path):
+    """Atomically writes a Parquet cache; failures such as a read-only directory are ignored."""
+    tmp_path = f"{parquet_path}.{os.getpid()}.tmp"
+    try:
+        df.to_parquet(tmp_path, compression='zstd')
+        os.replace(tmp_path, parquet_path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def slice_years(df, start_year, end_year):
+    """Returns the rows of a year-indexed, year-sorted frame in [start_year, end_year] via binary search."""
+    lo = df.index.searchsorted(start_year, side='left')
+    hi = df.index.searchsorted(end_year, side='right')
+    return df.iloc[lo:hi]
+
+def sum_by_county_year(crime_df):
+    """Sums the metric columns per (county, year) using a sort + reduceat pass."""
+    county_codes = crime_df['county_norm'].cat.codes.to_numpy()
+    years = crime_df['year'].to_numpy(dtype=np.float64, na_value=np.nan)
+    valid = (county_codes >= 0) & ~np.isnan(years)
+    # Pack (county code, year) into one uint32 so a single sort groups the rows
+    key = (county_codes[valid].astype(np.uint32) << 16) | years[valid].astype(np.uint32)
+    order = np.argsort(key, kind='stable')
+    sorted_key = key[order]
+    starts = np.flatnonzero(np.diff(sorted_key, prepend=sorted_key[0] + 1))
+    values = crime_df[METRIC_COLUMNS].to_numpy(dtype=np.int64, na_value=0)[valid][order]
+    sums = np.add.reduceat(values, starts, axis=0)
+    group_keys = sorted_key[starts]
+    crime_agg = pd.DataFrame(sums, columns=METRIC_COLUMNS)
+    crime_agg.insert(0, 'county_norm', pd.Categorical.from_codes((group_keys >> 16).astype(np.int32), crime_df['county_norm'].cat.categories))
+    crime_agg.insert(1, 'year', pd.array((group_keys & 0xFFFF).astype(np.int16), dtype='Int16'))
+    return crime_agg
+
+def data_version():
+    """Returns a short key identifying the current source data, used in place of hashing DataFrames."""
+    mtimes = [os.path.getmtime(path) if os.path.exists(path) else 0 for path in (CRIMES_PATH, POPULATION_PATH)]
+    return "-".join(f"{mtime:.0f}" for mtime in mtimes)
 
 # --- Data Loading and Processing Functions ---
 @st.cache_data
-def load_crime_data():
+def load_crime_data(version):
     """Loads, cleans, and normalizes the crime data."""
+    cached = read_parquet_cache(CRIMES_PARQUET_PATH, CRIMES_PATH)
+    if cached is not None:
+        return cached
     try:
-        df = pd.read_csv(CRIMES_PATH, low_memory=False)
+        df = pacsv.read_csv(
+            CRIMES_PATH,
+            convert_options=pacsv.ConvertOptions(column_types=CRIME_COLUMN_TYPES),
+        ).to_pandas(types_mapper=ARROW_TYPES_MAPPER)
     except FileNotFoundError:
         st.error(f"Crime data file not found at '{CRIMES_PATH}'. Make sure it's in the same directory as the app.")
         return None
-    df.columns = [to_snake_case(col) for col in df.columns]
-    for col in METRIC_COLUMNS + ['year', 'months_reported']:
-        df[col] = pd.to_numeric(df[col], errors='coerce')
-    df['county_norm'] = df['county'].str.strip().replace(COUNTY_NORMALIZATION)
+    df.columns = df.columns.str.lower().str.replace(' ', '_').str.replace('-', '_')
+    df['county_norm'] = df['county'].str.strip().replace(COUNTY_NORMALIZATION).astype('category')
+    df['agency'] = df['agency'].astype('category')
+    # Sort by year and index on it so year-range filters become index slices
+    df = df.dropna(subset=['year']).sort_values('year', kind='stable')
+    df = df.set_index('year', drop=False).rename_axis(None)
+    write_parquet_cache(df, CRIMES_PARQUET_PATH)
     return df
 
 @st.cache_data
-def load_population_data():
+def load_population_data(version):
     """Loads, cleans, and normalizes population data."""
+    cached = read_parquet_cache(POPULATION_PARQUET_PATH, POPULATION_PATH)
+    if cached is not None:
+        return cached
     try:
-        df = pd.read_csv(POPULATION_PATH, low_memory=False)
+        df = pacsv.read_csv(
+            POPULATION_PATH,
+            convert_options=pacsv.ConvertOptions(column_types=POPULATION_COLUMN_TYPES),
+        ).to_pandas(types_mapper=ARROW_TYPES_MAPPER)
     except FileNotFoundError:
         st.error(f"Population data file not found at '{POPULATION_PATH}'. Make sure it's in the same directory as the app.")
         return None
-    df.columns = [to_snake_case(col) for col in df.columns]
+    df.columns = df.columns.str.lower().str.replace(' ', '_').str.replace('-', '_')
     pop_col = next((c for c in ['population', 'pop', 'est_population'] if c in df.columns), None)
     if not pop_col:
         st.error("Population column not found in population data.")
         return None
     df.rename(columns={pop_col: 'population', 'fips_code': 'fips'}, inplace=True)
-    df['population'] = pd.to_numeric(df['population'], errors='coerce')
-    df['year'] = pd.to_numeric(df['year'], errors='coerce')
-    df['fips'] = df['fips'].astype(str).str.zfill(5)
-    df['county_norm'] = df['geography'].str.replace(' County', '').str.strip().replace(COUNTY_NORMALIZATION)
-    return df[['year', 'county_norm', 'population', 'fips']]
+    df['fips'] = df['fips'].str.zfill(5).astype('category')
+    df['county_norm'] = df['geography'].str.replace(' County', '').str.strip().replace(COUNTY_NORMALIZATION).astype('category')
+    df = df[['year', 'county_norm', 'population', 'fips']]
+    write_parquet_cache(df, POPULATION_PARQUET_PATH)
+    return df
 
 @st.cache_data
-def join_and_compute_metrics(crime_df, pop_df):
+def join_and_compute_metrics(_crime_df, _pop_df, version):
     """Aggregates crime data, joins with population, and computes rates."""
-    crime_agg = crime_df.groupby(['county_norm', 'year'])[METRIC_COLUMNS].sum().reset_index()
+    # Share one county category set so the merge and later groupbys stay on integer codes
+    cats = sorted(set(_crime_df['county_norm'].cat.categories) | set(_pop_df['county_norm'].cat.categories))
+    crime_df = _crime_df.assign(county_norm=_crime_df['county_norm'].cat.set_categories(cats))
+    pop_df = _pop_df.assign(county_norm=_pop_df['county_norm'].cat.set_categories(cats))
+    crime_agg = sum_by_county_year(crime_df)
     df = pd.merge(crime_agg, pop_df, on=['county_norm', 'year'], how='left')
-    for col in METRIC_COLUMNS:
-        rate_col = f'{col}_per_100k'
-        df[rate_col] = (df[col] / df['population']) * 100000
-    return df
+    # Compute every per-100k rate in one broadcast division over the metric block
+    population = df['population'].to_numpy(dtype=np.float64, na_value=np.nan)
+    rates = df[METRIC_COLUMNS].to_numpy(dtype=np.float64) / population[:, None] * 100000
+    rate_cols = [f'{col}_per_100k' for col in METRIC_COLUMNS]
+    df = pd.concat([df, pd.DataFrame(rates.astype(np.float32), columns=rate_cols, index=df.index)], axis=1)
+    df = df.sort_values('year', kind='stable')
+    return df.set_index('year', drop=False).rename_axis(None)
+
+@st.cache_data
+def yearly_totals(_full_df, version):
+    """Sums every metric per year into a small year x metric table."""
+    totals = _full_df.groupby('year')[METRIC_COLUMNS].sum().astype('float64')
+    totals.index = totals.index.astype(int)
+    # Years without rows get zero totals so any slider year can be looked up
+    years = pd.RangeIndex(totals.index.min(), totals.index.max() + 1)
+    return totals.reindex(years, fill_value=0)
+
+@st.cache_data
+def county_cumulative_totals(_full_df, version):
+    """Builds a year x (column, county, fips) table of running sums, starting with a zero row."""
+    rate_cols = [f'{m}_per_100k' for m in METRIC_COLUMNS]
+    df = _full_df.assign(
+        population_count=_full_df['population'].notna().astype(np.int32),
+        row_count=np.int32(1),
+    )
+    sum_cols = METRIC_COLUMNS + rate_cols + ['population', 'population_count', 'row_count']
+    by_year = df.groupby(['year', 'county_norm', 'fips'], observed=True)[sum_cols].sum()
+    by_year = by_year.unstack(['county_norm', 'fips'], fill_value=0)
+    by_year.index = by_year.index.astype(int)
+    # The leading zero row lets a range starting at the first year subtract "year - 1".
+    # Running sums are kept in float64 so subtracting two large totals stays exact enough for display.
+    years = pd.RangeIndex(by_year.index.min() - 1, by_year.index.max() + 1)
+    return by_year.astype('float64').reindex(years, fill_value=0).cumsum()
+
+@st.cache_data
+def compute_views(_full_df, version, start_year, end_year, metrics):
+    """Builds the map/ranking aggregate and KPIs for a filter selection."""
+    metrics = list(metrics)
+    rate_cols = [f'{m}_per_100k' for m in metrics]
+
+    # Per-county sums over [start_year, end_year] are a difference of two cumulative rows
+    cumulative = county_cumulative_totals(_full_df, version)
+    window = (cumulative.loc[end_year] - cumulative.loc[start_year - 1]).unstack(0)
+    window = window[window['row_count'] > 0]
+
+    # Create a single metric by summing the selected metrics for map/rankings,
+    # and sum the rate columns for a combined rate, each as one matrix-vector product
+    ones = np.ones(len(metrics), dtype=np.float64)
+    agg_df = pd.DataFrame({
+        'combined_metric': window[metrics].to_numpy(dtype=np.float64) @ ones,
+        'combined_rate': window[rate_cols].to_numpy(dtype=np.float64) @ ones, # You might want to average this instead
+        'population': (window['population'] / window['population_count']).to_numpy(),
+    }, index=window.index).reset_index()
+
+    yearly = yearly_totals(_full_df, version)
+    total_crimes = yearly.loc[start_year:end_year, metrics].to_numpy(dtype=np.float64).sum()
+
+    # Calculate change over the selected period
+    start_year_total = yearly.loc[start_year, metrics].to_numpy(dtype=np.float64).sum()
+    end_year_total = yearly.loc[end_year, metrics].to_numpy(dtype=np.float64).sum()
+    period_change = ((end_year_total - start_year_total) / start_year_total * 100) if start_year_total else 0
+
+    return {
+        'agg_df': agg_df,
+        'total_crimes': total_crimes,
+        'period_change': period_change,
+    }
+
+@st.cache_data
+def compute_trend(_full_df, version, metrics, value_type):
+    """Sums the selected metrics (or their rates) statewide for every year."""
+    cols = [f"{m}_per_100k" for m in metrics] if value_type == 'Per 100k' else list(metrics)
+    return _full_df.groupby('year')[cols].sum().reset_index()
 
 @st.cache_data
 def get_geojson():
     """Fetches and caches GeoJSON data for NY counties."""
+    if os.path.exists(GEOJSON_CACHE_PATH):
+        try:
+            with gzip.open(GEOJSON_CACHE_PATH, 'rb') as f:
+                return orjson.loads(f.read())
+        except (OSError, EOFError, ValueError):
+            pass  # Truncated or corrupt cache; fetch a fresh copy below
     try:
-        r = requests.get(GEOJSON_URL)
-        r.raise_for_status()
-        return r.json()
-    except requests.RequestException as e:
+        with urllib.request.urlopen(GEOJSON_URL, timeout=GEOJSON_TIMEOUT_SECONDS) as r:
+            gj = orjson.loads(r.read())
+        # Keep only New York counties; the map never renders the other states
+        gj['features'] = [f for f in gj['features'] if f['id'].startswith(NY_STATE_FIPS)]
+    # OSError covers URLError, dropped connections and socket timeouts; ValueError covers JSONDecodeError
+    except (OSError, http.client.HTTPException, ValueError) as e:
         st.error(f"Failed to fetch GeoJSON: {e}")
         return None
+    except (KeyError, TypeError, AttributeError) as e:
+        st.error(f"Fetched GeoJSON is not a FeatureCollection with county ids: {e!r}")
+        return None
+    # Hover text comes from the DataFrame, so feature properties are dead weight in the browser payload
+    for f in gj['features']:
+        f['properties'] = {}
+    tmp_path = f"{GEOJSON_CACHE_PATH}.{os.getpid()}.tmp"
+    try:
+        with gzip.open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(gj))
+        os.replace(tmp_path, GEOJSON_CACHE_PATH)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return gj
 
 # --- Main Application ---
 st.title("🗽 New York State Crime Analytics Dashboard")
 
 # --- Load Data ---
-crime_df = load_crime_data()
-pop_df = load_population_data()
-geojson = get_geojson()
+# Parse both CSVs and fetch the GeoJSON concurrently; workers inherit the script
+# context so cache lookups and st.error calls inside the loaders still work.
+version = data_version()
+script_ctx = get_script_run_ctx()
+with ThreadPoolExecutor(
+    max_workers=3,
+    initializer=lambda: add_script_run_ctx(threading.current_thread(), script_ctx),
+) as executor:
+    crime_future = executor.submit(load_crime_data, version)
+    pop_future = executor.submit(load_population_data, version)
+    geojson_future = executor.submit(get_geojson)
+    crime_df, pop_df, geojson = crime_future.result(), pop_future.result(), geojson_future.result()
 
 if crime_df is None or pop_df is None or geojson is None:
     st.warning("Could not load data. Please ensure the required CSV files are present.")
     st.stop()
 
-full_df = join_and_compute_metrics(crime_df, pop_df)
+full_df = join_and_compute_metrics(crime_df, pop_df, version)
 
 # --- Sidebar Controls ---
 st.sidebar.header("Dashboard Filters")
@@ -123,35 +324,13 @@ if not selected_metrics:
     st.stop()
 
 # --- Data Aggregation Based on Filters ---
-# Filter data for the selected year range
-range_df = full_df[full_df['year'].between(start_year, end_year)]
-
-# Create a single metric by summing the selected metrics for map/rankings
-range_df['combined_metric'] = range_df[selected_metrics].sum(axis=1)
-for metric in selected_metrics:
-    rate_col = f'{metric}_per_100k'
-    range_df[rate_col] = (range_df[metric] / range_df['population']) * 100000
-
-# Sum selected rate columns for a combined rate
-rate_cols = [f'{m}_per_100k' for m in selected_metrics]
-range_df['combined_rate'] = range_df[rate_cols].sum(axis=1)
-
-# Aggregate over the year range for map and rankings
-agg_df = range_df.groupby(['county_norm', 'fips']).agg({
-    'combined_metric': 'sum',
-    'combined_rate': 'sum', # You might want to average this instead
-    'population': 'mean'
-}).reset_index()
+views = compute_views(full_df, version, start_year, end_year, tuple(selected_metrics))
+agg_df = views['agg_df']
 
 # --- KPI Section ---
 st.header(f"Statewide Summary for {start_year} - {end_year}")
-kpi_data = full_df[full_df['year'].between(start_year, end_year)]
-total_crimes = kpi_data[selected_metrics].sum().sum()
-
-# Calculate change over the selected period
-start_year_total = full_df[full_df['year'] == start_year][selected_metrics].sum().sum()
-end_year_total = full_df[full_df['year'] == end_year][selected_metrics].sum().sum()
-period_change = ((end_year_total - start_year_total) / start_year_total * 100) if start_year_total else 0
+total_crimes = views['total_crimes']
+period_change = views['period_change']
 
 col1, col2 = st.columns(2)
 col1.metric(f"Total Selected Crimes ({start_year}-{end_year})", f"{total_crimes:,.0f}")
@@ -160,27 +339,30 @@ col2.metric(f"Change Over Period ({start_year} vs {end_year})", f"{period_change
 # --- Map View ---
 st.header("County Crime Map")
 color_col = 'combined_rate' if value_type == 'Per 100k' else 'combined_metric'
+# Color by quantile bin so the map shades on a small integer range; hover still shows exact values.
+# Tied values can merge bins, so the color range follows the highest bin actually produced.
+agg_df['color_bin'] = pd.qcut(agg_df[color_col], MAP_COLOR_BINS, labels=False, duplicates='drop')
 fig = px.choropleth_mapbox(
     agg_df,
     geojson=geojson,
     locations='fips',
-    color=color_col,
+    color='color_bin',
     color_continuous_scale="Viridis",
+    range_color=(0, agg_df['color_bin'].max()),
     mapbox_style="carto-positron",
     zoom=6, center={"lat": 42.9, "lon": -75.5},
     opacity=0.6,
     hover_name='county_norm',
-    hover_data={'fips': False, 'combined_metric': ':,', 'combined_rate': ':.2f'},
-    labels={color_col: f"Total ({value_type})"}
+    hover_data={'fips': False, 'color_bin': False, 'combined_metric': ':,', 'combined_rate': ':.2f'},
+    labels={'color_bin': f"Quantile Bin ({value_type})"}
 )
 fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
 st.plotly_chart(fig, use_container_width=True)
 
 # --- Trend View ---
 st.header("Historical Trend")
-trend_df = full_df[full_df['year'].between(min_year, max_year)]
 trend_metrics = [f"{m}_per_100k" for m in selected_metrics] if value_type == 'Per 100k' else selected_metrics
-statewide_trend = trend_df.groupby('year')[trend_metrics].sum().reset_index()
+statewide_trend = compute_trend(full_df, version, tuple(selected_metrics), value_type)
 
 trend_fig = px.line(
     statewide_trend,
@@ -210,5 +392,11 @@ with col2:
 
 # --- Agency Table ---
 st.header("Agency-Level Data")
-agency_data = crime_df[crime_df['year'].between(start_year, end_year)]
-st.dataframe(agency_data[['year', 'county_norm', 'agency', 'months_reported'] + selected_metrics])
\ No newline at end of file
+agency_data = slice_years(crime_df, start_year, end_year)
+# crime_df is sorted oldest-first for slicing; show newest years first like the source CSV
+agency_data = agency_data.sort_values('year', ascending=False, kind='stable')
+agency_table = pa.Table.from_pandas(
+    agency_data[['year', 'county_norm', 'agency', 'months_reported'] + selected_metrics],
+    preserve_index=False,
+)
+st.dataframe(agency_table)
\ No newline at end of file